@@ -0,0 +1,79 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+import aiosqlite
+
+# Database setup with Railway Volume support
+DATA_DIR = os.getenv("DATA_DIR", ".")
+DB_PATH = os.path.join(DATA_DIR, "auto_grader.db")
+
+# Applied to every connection: WAL lets readers run alongside the grading writer,
+# and NORMAL sync avoids an fsync per commit (still durable at checkpoints).
+DB_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA busy_timeout=5000;
+    PRAGMA foreign_keys=ON;
+"""
+
+READER_COUNT = int(os.getenv("DB_READERS", str(os.cpu_count() or 4)))
+
+async def connect_db():
+    conn = await aiosqlite.connect(DB_PATH, isolation_level=None)
+    await conn.executescript(DB_PRAGMAS)
+    conn.row_factory = aiosqlite.Row
+    return conn
+
+# SQLite allows a single writer at a time, so all writes share one connection
+_writer = None
+_writer_lock = asyncio.Lock()
+
+# Long-lived reader connections keep their page cache warm between requests
+_readers = asyncio.Queue()
+
+async def open_pool():
+    global _writer
+    # Nothing touches the filesystem at import time; the data directory is created here,
+    # before init_db/init_cache run
+    os.makedirs(DATA_DIR, exist_ok=True)
+    print(f"[DB] Database path: {DB_PATH}")
+    _writer = await connect_db()
+    for _ in range(READER_COUNT):
+        _readers.put_nowait(await connect_db())
+
+async def close_pool():
+    global _writer
+    while not _readers.empty():
+        await _readers.get_nowait().close()
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+
+@asynccontextmanager
+async def get_read_conn():
+    """Borrow a reader connection from the pool"""
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+@asynccontextmanager
+async def get_write_conn():
+    """
+    Hold the writer connection for one transaction, committed on exit and
+    rolled back if the block raises.
+
+    Other writers wait while it is held, so avoid slow awaits (e.g. OpenAI calls) inside.
+    """
+    async with _writer_lock:
+        await _writer.execute("BEGIN IMMEDIATE")
+        try:
+            yield _writer
+        except BaseException:
+            await _writer.execute("ROLLBACK")
+            raise
+        else:
+            await _writer.execute("COMMIT")
@@ -1,59 +1,167 @@
 import os
-from openai import OpenAI
-import json
+import asyncio
+import time
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from openai import AsyncOpenAI
+import numpy as np
+import orjson
+from db_pool import get_read_conn, get_write_conn
+from grading_postprocess import summarize, postprocess
 
 # Initialize OpenAI client with stripped API key
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY").strip())
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY").strip())
 
-def grade_submission(task_prompt: str, user_prompt: str, num_runs: int = 3) -> dict:
-    """
-    Grade a user's prompt submission by running it 3 times and averaging the scores.
+MODEL = "gpt-4o-mini"
+# Deterministic sampling, so a single run is enough and re-grades hit the exact-match cache
+TEMPERATURE = 0
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Cached grades are reused for near-duplicate submissions above this cosine similarity
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+# Trivial submissions are scored locally without calling the grader. The minimum is in
+# UTF-8 bytes, so a short Korean prompt (3 bytes per syllable) is not mistaken for an empty one.
+MIN_PROMPT_BYTES = 10
+OFF_TOPIC_THRESHOLD = 0.1
+OFF_TOPIC_SCORE = 10
+
+class TokenRateLimiter:
+    """Sliding-window tokens-per-minute counter shared by all grading calls"""
     
-    Args:
-        task_prompt: The assignment/task description
-        user_prompt: The user's submitted prompt
-        num_runs: Number of times to run the evaluation (default: 3)
+    def __init__(self, tokens_per_minute: int, window: float = 60.0):
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.events = deque()  # (timestamp, tokens)
+        self.used = 0
     
-    Returns:
-        dict with average_score, detailed_scores, and feedback
-    """
+    def _evict(self, now: float):
+        while self.events and now - self.events[0][0] >= self.window:
+            _, tokens = self.events.popleft()
+            self.used -= tokens
+    
+    async def wait(self):
+        """Block until the last minute's usage is back under the limit"""
+        while True:
+            now = time.monotonic()
+            self._evict(now)
+            if self.used < self.tokens_per_minute:
+                return
+            delay = self.window - (now - self.events[0][0])
+            print(f"[GRADING_ENGINE] TPM limit reached ({self.used} tokens), waiting {delay:.1f}s")
+            await asyncio.sleep(delay)
+    
+    def record(self, tokens: int):
+        self.events.append((time.monotonic(), tokens))
+        self.used += tokens
+
+rate_limiter = TokenRateLimiter(int(os.getenv("GRADER_TPM_LIMIT", "200000")))
+
+# Response parsing and score aggregation run here so the event loop stays responsive.
+# Workers come from a forkserver: forking the app itself would copy the aiosqlite threads' locks.
+# Parsing is light, so a few workers suffice; the affinity mask reflects the CPUs this process may use.
+_available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+executor = ProcessPoolExecutor(max_workers=int(os.getenv("GRADER_WORKERS", str(min(4, _available_cpus)))),
+                               mp_context=multiprocessing.get_context("forkserver"))
+
+def _record_usage(response):
+    if response.usage is not None:
+        rate_limiter.record(response.usage.total_tokens)
+
+# ==================== GRADING CACHE ====================
+
+async def init_cache():
+    async with get_write_conn() as conn:
+        await conn.execute('''CREATE TABLE IF NOT EXISTS grading_cache
+                     (key BLOB PRIMARY KEY,
+                      task_key BLOB NOT NULL,
+                      score REAL,
+                      feedback TEXT,
+                      details TEXT,
+                      embedding BLOB)''')
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_task ON grading_cache(task_key)")
+
+
+def _hash(*parts) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\x00')
+    return h.digest()
+
+# Keys cover everything that shapes a grade, including the rubric, so editing
+# EVALUATION_SYSTEM_PROMPT stops old grades from being served
+def _task_key(task_prompt: str, num_runs: int) -> bytes:
+    return _hash(task_prompt, MODEL, TEMPERATURE, num_runs, EVALUATION_SYSTEM_PROMPT)
+
+def _cache_key(task_prompt: str, user_prompt: str, num_runs: int) -> bytes:
+    return _hash(task_prompt, user_prompt, MODEL, TEMPERATURE, num_runs, EVALUATION_SYSTEM_PROMPT)
+
+def _row_to_result(row) -> dict:
+    return {
+        "average_score": row['score'],
+        "detailed_scores": orjson.loads(row['details']),
+        "feedback": row['feedback']
+    }
+
+async def _cache_lookup(keys: list) -> dict:
+    """Exact-match lookup; returns {key: result} for the keys found"""
+    async with get_read_conn() as conn:
+        c = await conn.execute(f"SELECT key, score, feedback, details FROM grading_cache WHERE key IN ({','.join('?' * len(keys))})",
+                               keys)
+        found = {row['key']: _row_to_result(row) for row in await c.fetchall()}
+    return found
+
+async def _cache_lookup_similar(task_key: bytes, embeddings: np.ndarray) -> list:
+    """Semantic lookup among cached grades for the same task; returns a result or None per embedding"""
+    async with get_read_conn() as conn:
+        c = await conn.execute("SELECT score, feedback, details, embedding FROM grading_cache WHERE task_key = ? AND embedding IS NOT NULL",
+                               (task_key,))
+        rows = await c.fetchall()
     
-    scores = []
-    feedbacks = []
+    if not rows:
+        return [None] * len(embeddings)
     
-    print(f"[GRADING_ENGINE] Starting grading with {num_runs} runs")
+    cached = np.stack([np.frombuffer(row['embedding'], dtype=np.float32) for row in rows])
+    # Embeddings are unit-normalised, so the dot product is the cosine similarity
+    similarity = embeddings @ cached.T
+    best = similarity.argmax(axis=1)
     
-    for run in range(num_runs):
-        try:
-            print(f"[GRADING_ENGINE] Run {run + 1}/{num_runs}")
-            
-            # Execute the user's prompt
-            execution_response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": task_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7
-            )
-            
-            output = execution_response.choices[0].message.content
-            print(f"[GRADING_ENGINE] Execution output length: {len(output)} chars")
-            
-            # Evaluate the output
-            evaluation_prompt = f"""
-당신은 프롬프트 평가 전문가입니다.
+    return [_row_to_result(rows[j]) if similarity[i, j] > SEMANTIC_CACHE_THRESHOLD else None
+            for i, j in enumerate(best)]
+
+async def _cache_store(entries: list):
+    """Store (key, task_key, result, embedding) tuples"""
+    async with get_write_conn() as conn:
+        await conn.executemany("INSERT OR REPLACE INTO grading_cache (key, task_key, score, feedback, details, embedding) VALUES (?, ?, ?, ?, ?, ?)",
+                               [(key, task_key, result['average_score'], result['feedback'], orjson.dumps(result['detailed_scores']).decode(),
+                                 embedding.tobytes() if embedding is not None else None)
+                                for key, task_key, result, embedding in entries])
+
+# Task prompt embeddings, reused across batches of the same assignment
+_task_embeddings = {}
 
-**과제 설명:**
-{task_prompt}
+async def _embed(texts: list) -> np.ndarray:
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+    embeddings = np.array([item.embedding for item in response.data], dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
 
-**제출된 프롬프트:**
-{user_prompt}
+# ==================== GRADING ====================
 
-**프롬프트 실행 결과:**
-{output}
+# Kept byte-identical across calls so OpenAI's automatic prompt caching can
+# reuse it as a prefix; all per-submission content goes in the user message.
+EVALUATION_SYSTEM_PROMPT = """You are a prompt evaluation expert. Always respond in valid JSON format.
+
+당신은 프롬프트 평가 전문가입니다.
 
-다음 기준으로 제출된 프롬프트를 평가해주세요:
+사용자 메시지는 다음 형식으로 주어집니다:
+과제: <과제 설명>
+제출: <제출된 프롬프트 목록 (JSON 배열, 각 항목은 id와 prompt)>
+
+각 제출물마다 먼저 과제 설명을 시스템 지시로 삼아 제출된 프롬프트를 그대로 실행한 결과를 작성하세요.
+그 다음 실행 결과를 바탕으로 다음 기준에 따라 제출된 프롬프트를 평가해주세요:
 
 1. **과제 이해도 (20점)**: 프롬프트가 과제 요구사항을 정확히 이해했는가?
 2. **명확성 (20점)**: 프롬프트가 명확하고 구체적인가?
@@ -61,51 +169,207 @@ def grade_submission(task_prompt: str, user_prompt: str, num_runs: int = 3) -> d
 4. **실행 결과 품질 (20점)**: 실제 출력물이 과제 목표를 달성했는가?
 5. **완성도 (20점)**: 전체적으로 완성도가 높은가?
 
+각 제출물은 서로 독립적으로 평가하고, 모든 id에 대해 결과를 반환하세요.
+
 **응답 형식 (JSON):**
-{{
-    "score": <0-100 사이의 점수>,
-    "feedback": "<구체적인 피드백 (200자 이내)>",
-    "strengths": "<강점>",
-    "improvements": "<개선점>"
-}}
+{
+    "results": [
+        {
+            "id": <제출물 id>,
+            "output": "<프롬프트 실행 결과>",
+            "score": <0-100 사이의 점수>,
+            "feedback": "<구체적인 피드백 (200자 이내)>",
+            "strengths": "<강점>",
+            "improvements": "<개선점>"
+        }
+    ]
+}
 """
-            
-            evaluation_response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a prompt evaluation expert. Always respond in valid JSON format."},
-                    {"role": "user", "content": evaluation_prompt}
-                ],
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            result = json.loads(evaluation_response.choices[0].message.content)
-            score = result.get('score', 0)
-            feedback = result.get('feedback', '')
-            
-            scores.append(score)
-            feedbacks.append(feedback)
-            
-            print(f"[GRADING_ENGINE] Run {run + 1} score: {score}")
-            
-        except Exception as e:
-            error_msg = f"프롬프트 실행 실패: {str(e)}"
+
+async def _grade_uncached(task_prompt: str, user_prompts: list, num_runs: int) -> list:
+    """
+    Grade several prompt submissions for the same task in one request per run.
+    All runs are executed concurrently. Submissions left out of a truncated or
+    incomplete response are split off and retried in smaller requests.
+    
+    Args:
+        task_prompt: The assignment/task description
+        user_prompts: The users' submitted prompts
+        num_runs: Number of times to run the evaluation
+    
+    Returns:
+        list of dicts with average_score, detailed_scores, and feedback,
+        in the same order as user_prompts; a submission that could not be
+        graded even on its own is an Exception in its place
+    """
+    
+    print(f"[GRADING_ENGINE] Starting batched grading of {len(user_prompts)} prompts with {num_runs} runs")
+    
+    submissions_json = orjson.dumps(
+        [{"id": i, "prompt": prompt} for i, prompt in enumerate(user_prompts)]
+    ).decode()
+    
+    # Only the variable content goes in the user message; the rubric is a fixed system prefix
+    evaluation_prompt = f"과제: {task_prompt}\n제출: {submissions_json}"
+    
+    async def _one_run(run: int):
+        print(f"[GRADING_ENGINE] Run {run + 1}/{num_runs}")
+        
+        await rate_limiter.wait()
+        evaluation_response = await client.chat.completions.create(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": EVALUATION_SYSTEM_PROMPT},
+                {"role": "user", "content": evaluation_prompt}
+            ],
+            temperature=TEMPERATURE,
+            response_format={"type": "json_object"}
+        )
+        
+        _record_usage(evaluation_response)
+        return evaluation_response.choices[0]
+    
+    choices = await asyncio.gather(*[_one_run(i) for i in range(num_runs)], return_exceptions=True)
+    
+    for choice in choices:
+        if isinstance(choice, Exception):
+            error_msg = f"프롬프트 실행 실패: {str(choice)}"
             print(f"[GRADING_ENGINE ERROR] {error_msg}")
             raise Exception(error_msg)
     
-    # Calculate average
-    average_score = sum(scores) / len(scores)
+    if any(choice.finish_reason == 'length' for choice in choices):
+        # Output limit reached: whatever was parsed belongs to a cut-off JSON document
+        print(f"[GRADING_ENGINE] Response truncated for {len(user_prompts)} prompts")
+        graded = [None] * len(user_prompts)
+    else:
+        # Parse and aggregate off the event loop
+        loop = asyncio.get_running_loop()
+        graded = await loop.run_in_executor(executor, postprocess,
+                                            [choice.message.content for choice in choices], len(user_prompts))
     
-    # Combine feedback
-    combined_feedback = f"평균 점수: {average_score:.2f}점\n\n"
-    combined_feedback += "각 실행별 점수: " + ", ".join([f"{s:.2f}점" for s in scores]) + "\n\n"
-    combined_feedback += "종합 피드백:\n" + feedbacks[0]  # Use first feedback as representative
+    incomplete = [i for i, result in enumerate(graded) if result is None]
+    if incomplete:
+        if len(user_prompts) == 1:
+            error_msg = "평가 결과 누락: 응답이 잘렸거나 형식이 올바르지 않습니다"
+            print(f"[GRADING_ENGINE ERROR] {error_msg}")
+            raise Exception(error_msg)
+        
+        # Retry the missing submissions in two halves, down to one per request
+        print(f"[GRADING_ENGINE] Retrying {len(incomplete)} ungraded prompts in smaller batches")
+        half = (len(incomplete) + 1) // 2
+        parts = [part for part in (incomplete[:half], incomplete[half:]) if part]
+        retried = await asyncio.gather(
+            *[_grade_uncached(task_prompt, [user_prompts[i] for i in part], num_runs) for part in parts],
+            return_exceptions=True
+        )
+        for part, results in zip(parts, retried):
+            for i, result in zip(part, results if isinstance(results, list) else [results] * len(part)):
+                graded[i] = result
     
-    print(f"[GRADING_ENGINE] ✓ Grading completed. Average: {average_score:.2f}")
+    print(f"[GRADING_ENGINE] ✓ Batched grading completed. Averages: {[g['average_score'] if isinstance(g, dict) else None for g in graded]}")
     
-    return {
-        "average_score": round(average_score, 2),
-        "detailed_scores": scores,
-        "feedback": combined_feedback
-    }
+    return graded
+
+async def grade_submissions_batched(task_prompt: str, user_prompts: list, num_runs: int = 1) -> list:
+    """
+    Grade several prompt submissions for the same task, reusing cached grades
+    for identical or near-identical submissions and scoring empty or off-topic
+    prompts locally.
+    
+    Args:
+        task_prompt: The assignment/task description
+        user_prompts: The users' submitted prompts
+        num_runs: Number of times to run the evaluation (default: 1)
+    
+    Returns:
+        list of dicts with average_score, detailed_scores, and feedback,
+        in the same order as user_prompts; a submission that could not be
+        graded is an Exception in its place
+    """
+    
+    graded = [None] * len(user_prompts)
+    
+    # Empty or near-empty prompts get 0 without any API call
+    for i, prompt in enumerate(user_prompts):
+        if len((prompt or '').strip().encode('utf-8')) < MIN_PROMPT_BYTES:
+            graded[i] = summarize([0], ["빈 프롬프트: 제출된 프롬프트가 비어 있거나 너무 짧습니다."])
+    
+    task_key = _task_key(task_prompt, num_runs)
+    keys = [_cache_key(task_prompt, prompt, num_runs) for prompt in user_prompts]
+    
+    # Exact-match cache
+    cached = await _cache_lookup([keys[i] for i, result in enumerate(graded) if result is None])
+    for i, key in enumerate(keys):
+        if graded[i] is None:
+            graded[i] = cached.get(key)
+    misses = [i for i, result in enumerate(graded) if result is None]
+    print(f"[GRADING_ENGINE] Cache: {len(user_prompts) - len(misses)}/{len(user_prompts)} exact hits or empty prompts")
+    
+    if not misses:
+        return graded
+    
+    embeddings = None
+    try:
+        # Embed the task prompt along with the submissions the first time it is seen
+        texts = [user_prompts[i] for i in misses]
+        task_embedding_key = _hash(task_prompt, EMBEDDING_MODEL)
+        task_embedding = _task_embeddings.get(task_embedding_key)
+        if task_embedding is None:
+            texts.append(task_prompt)
+        embeddings = await _embed(texts)
+        if task_embedding is None:
+            task_embedding = _task_embeddings[task_embedding_key] = embeddings[-1]
+            embeddings = embeddings[:-1]
+        
+        # Submissions unrelated to the task get a fixed low score
+        relevance = embeddings @ task_embedding
+        for i, similarity in zip(misses, relevance):
+            if similarity < OFF_TOPIC_THRESHOLD:
+                graded[i] = summarize([OFF_TOPIC_SCORE], ["과제 범위 이탈: 제출된 프롬프트가 과제 내용과 관련이 없습니다."])
+        
+        # Semantic cache over submissions to the same task
+        similar = await _cache_lookup_similar(task_key, embeddings)
+        for i, result in zip(misses, similar):
+            if graded[i] is None:
+                graded[i] = result
+    except Exception as e:
+        print(f"[GRADING_ENGINE] Semantic cache unavailable: {str(e)}")
+    
+    to_grade = [i for i in misses if graded[i] is None]
+    print(f"[GRADING_ENGINE] Cache: {len(misses) - len(to_grade)} semantic hits or off-topic, {len(to_grade)} to grade")
+    
+    if to_grade:
+        try:
+            results = await _grade_uncached(task_prompt, [user_prompts[i] for i in to_grade], num_runs)
+        except Exception as e:
+            # Only the submissions sent to the grader fail; cached and locally scored ones are kept
+            results = [e] * len(to_grade)
+        
+        embedding_of = dict(zip(misses, embeddings)) if embeddings is not None else {}
+        entries = []
+        for i, result in zip(to_grade, results):
+            graded[i] = result
+            if not isinstance(result, Exception):
+                entries.append((keys[i], task_key, result, embedding_of.get(i)))
+        if entries:
+            await _cache_store(entries)
+    
+    return graded
+
+async def grade_submission(task_prompt: str, user_prompt: str, num_runs: int = 1) -> dict:
+    """
+    Grade a user's prompt submission, averaging the scores when num_runs > 1.
+    
+    Args:
+        task_prompt: The assignment/task description
+        user_prompt: The user's submitted prompt
+        num_runs: Number of times to run the evaluation (default: 1)
+    
+    Returns:
+        dict with average_score, detailed_scores, and feedback
+    """
+    
+    results = await grade_submissions_batched(task_prompt, [user_prompt], num_runs=num_runs)
+    if isinstance(results[0], Exception):
+        raise results[0]
+    return results[0]
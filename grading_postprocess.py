@@ -0,0 +1,46 @@
+import orjson
+
+# Response parsing and score aggregation for the grading worker processes.
+# Kept apart from grading_engine so a worker only imports orjson to unpickle them.
+
+def summarize(scores: list, feedbacks: list) -> dict:
+    """Average the per-run scores and compose the combined feedback"""
+    average_score = sum(scores) / len(scores)
+    
+    combined_feedback = f"평균 점수: {average_score:.2f}점\n\n"
+    combined_feedback += "각 실행별 점수: " + ", ".join([f"{s:.2f}점" for s in scores]) + "\n\n"
+    combined_feedback += "종합 피드백:\n" + feedbacks[0]  # Use first feedback as representative
+    
+    return {
+        "average_score": round(average_score, 2),
+        "detailed_scores": scores,
+        "feedback": combined_feedback
+    }
+
+def postprocess(contents: list, num_prompts: int) -> list:
+    """
+    Parse the raw evaluation responses of every run and summarize each submission (runs in a worker process).
+    Submissions missing from any run's response come back as None.
+    """
+    runs = []
+    for run, content in enumerate(contents):
+        by_id = {}
+        try:
+            for item in orjson.loads(content).get('results', []):
+                by_id[int(item['id'])] = (item.get('score', 0), item.get('feedback', ''))
+        except (orjson.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"[GRADING_ENGINE] Run {run + 1} response could not be parsed: {str(e)}")
+        
+        print(f"[GRADING_ENGINE] Run {run + 1} scores: {[by_id[i][0] if i in by_id else None for i in range(num_prompts)]}")
+        runs.append(by_id)
+    
+    graded = []
+    for i in range(num_prompts):
+        if any(i not in by_id for by_id in runs):
+            graded.append(None)
+            continue
+        scores = [by_id[i][0] for by_id in runs]
+        feedbacks = [by_id[i][1] for by_id in runs]
+        graded.append(summarize(scores, feedbacks))
+    
+    return graded
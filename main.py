@@ -1,22 +1,39 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
-import sqlite3
 import os
+import posixpath
+import re
+import asyncio
 import zipfile
 import csv
 import io
 from datetime import datetime
-import json
-import statistics
+import orjson
+import math
+from contextlib import asynccontextmanager
 
 # Import grading engine
-from grading_engine import grade_submission
-
-app = FastAPI(title="Auto-Grader API", version="1.0.0")
+from grading_engine import grade_submissions_batched, init_cache, executor
+from db_pool import open_pool, close_pool, get_read_conn, get_write_conn
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_pool()
+    await init_db()
+    await init_cache()
+    # Rows claimed by a grading run that died with the previous process go back to the queue
+    async with get_write_conn() as conn:
+        await conn.execute("UPDATE submissions SET status = 'pending' WHERE status = 'grading'")
+    yield
+    await close_pool()
+    executor.shutdown()
+
+app = FastAPI(title="Auto-Grader API", version="1.0.0", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -27,60 +44,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Database setup with Railway Volume support
-DATA_DIR = os.getenv("DATA_DIR", ".")
-os.makedirs(DATA_DIR, exist_ok=True)
-DB_PATH = os.path.join(DATA_DIR, "auto_grader.db")
-print(f"[DB] Database path: {DB_PATH}")
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Competitions table
-    c.execute('''CREATE TABLE IF NOT EXISTS competitions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  description TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Assignments table
-    c.execute('''CREATE TABLE IF NOT EXISTS assignments
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  competition_id INTEGER,
-                  name TEXT NOT NULL,
-                  prompt TEXT NOT NULL,
-                  FOREIGN KEY (competition_id) REFERENCES competitions(id))''')
-    
-    # Participants table
-    c.execute('''CREATE TABLE IF NOT EXISTS participants
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  competition_id INTEGER,
-                  name TEXT NOT NULL,
-                  email TEXT,
-                  student_id TEXT,
-                  FOREIGN KEY (competition_id) REFERENCES competitions(id))''')
-    
-    # Submissions table
-    c.execute('''CREATE TABLE IF NOT EXISTS submissions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  competition_id INTEGER,
-                  participant_id INTEGER,
-                  assignment_id INTEGER,
-                  prompt_text TEXT,
-                  submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  status TEXT DEFAULT 'pending',
-                  score REAL,
-                  feedback TEXT,
-                  grading_details TEXT,
-                  FOREIGN KEY (competition_id) REFERENCES competitions(id),
-                  FOREIGN KEY (participant_id) REFERENCES participants(id),
-                  FOREIGN KEY (assignment_id) REFERENCES assignments(id))''')
-    
-    conn.commit()
-    conn.close()
-
-init_db()
+async def init_db():
+    async with get_write_conn() as conn:
+        # Competitions table
+        await conn.execute('''CREATE TABLE IF NOT EXISTS competitions
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      name TEXT NOT NULL,
+                      description TEXT,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        
+        # Assignments table
+        await conn.execute('''CREATE TABLE IF NOT EXISTS assignments
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      competition_id INTEGER,
+                      name TEXT NOT NULL,
+                      prompt TEXT NOT NULL,
+                      FOREIGN KEY (competition_id) REFERENCES competitions(id))''')
+        
+        # Participants table
+        await conn.execute('''CREATE TABLE IF NOT EXISTS participants
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      competition_id INTEGER,
+                      name TEXT NOT NULL,
+                      email TEXT,
+                      student_id TEXT,
+                      FOREIGN KEY (competition_id) REFERENCES competitions(id))''')
+        
+        # Submissions table
+        await conn.execute('''CREATE TABLE IF NOT EXISTS submissions
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      competition_id INTEGER,
+                      participant_id INTEGER,
+                      assignment_id INTEGER,
+                      prompt_text TEXT,
+                      submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      status TEXT DEFAULT 'pending',
+                      score REAL,
+                      feedback TEXT,
+                      grading_details TEXT,
+                      FOREIGN KEY (competition_id) REFERENCES competitions(id),
+                      FOREIGN KEY (participant_id) REFERENCES participants(id),
+                      FOREIGN KEY (assignment_id) REFERENCES assignments(id))''')
+        
+        # Indexes for the competition/status filters and join columns
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_sub_comp_status ON submissions(competition_id, status)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_sub_participant ON submissions(participant_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_sub_assignment ON submissions(assignment_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_assign_comp ON assignments(competition_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_part_comp ON participants(competition_id)")
+
 
 # Pydantic models
 class Competition(BaseModel):
@@ -96,12 +108,6 @@ class ParticipantUpload(BaseModel):
     email: Optional[str] = None
     student_id: Optional[str] = None
 
-# Helper functions
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
 # ==================== COMPETITION ENDPOINTS ====================
 
 @app.get("/")
@@ -117,51 +123,41 @@ async def health():
 @app.post("/competitions")
 async def create_competition(comp: Competition):
     """Create a new competition"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT INTO competitions (name, description) VALUES (?, ?)",
-              (comp.name, comp.description))
-    comp_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    async with get_write_conn() as conn:
+        c = await conn.execute("INSERT INTO competitions (name, description) VALUES (?, ?)",
+                               (comp.name, comp.description))
+        comp_id = c.lastrowid
     return {"id": comp_id, "name": comp.name, "description": comp.description}
 
 @app.get("/competitions")
 async def list_competitions():
     """List all competitions"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM competitions ORDER BY created_at DESC")
-    competitions = [dict(row) for row in c.fetchall()]
-    conn.close()
+    async with get_read_conn() as conn:
+        c = await conn.execute("SELECT * FROM competitions ORDER BY created_at DESC")
+        competitions = [dict(row) for row in await c.fetchall()]
     return competitions
 
 @app.get("/competitions/{competition_id}")
 async def get_competition(competition_id: int):
     """Get competition details"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get competition
-    c.execute("SELECT * FROM competitions WHERE id = ?", (competition_id,))
-    comp = c.fetchone()
-    if not comp:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Competition not found")
-    
-    # Get assignments
-    c.execute("SELECT * FROM assignments WHERE competition_id = ?", (competition_id,))
-    assignments = [dict(row) for row in c.fetchall()]
-    
-    # Get participants
-    c.execute("SELECT * FROM participants WHERE competition_id = ?", (competition_id,))
-    participants = [dict(row) for row in c.fetchall()]
-    
-    # Get submissions
-    c.execute("SELECT * FROM submissions WHERE competition_id = ?", (competition_id,))
-    submissions = [dict(row) for row in c.fetchall()]
-    
-    conn.close()
+    async with get_read_conn() as conn:
+        # Get competition
+        c = await conn.execute("SELECT * FROM competitions WHERE id = ?", (competition_id,))
+        comp = await c.fetchone()
+        if not comp:
+            raise HTTPException(status_code=404, detail="Competition not found")
+        
+        # Get assignments
+        c = await conn.execute("SELECT * FROM assignments WHERE competition_id = ?", (competition_id,))
+        assignments = [dict(row) for row in await c.fetchall()]
+        
+        # Get participants
+        c = await conn.execute("SELECT * FROM participants WHERE competition_id = ?", (competition_id,))
+        participants = [dict(row) for row in await c.fetchall()]
+        
+        # Get submissions
+        c = await conn.execute("SELECT * FROM submissions WHERE competition_id = ?", (competition_id,))
+        submissions = [dict(row) for row in await c.fetchall()]
     
     return {
         **dict(comp),
@@ -175,31 +171,24 @@ async def get_competition(competition_id: int):
 @app.post("/competitions/{competition_id}/assignments")
 async def create_assignment(competition_id: int, assignment: Assignment):
     """Create assignment for competition"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Verify competition exists
-    c.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
-    if not c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Competition not found")
-    
-    c.execute("INSERT INTO assignments (competition_id, name, prompt) VALUES (?, ?, ?)",
-              (competition_id, assignment.name, assignment.prompt))
-    assignment_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    async with get_write_conn() as conn:
+        # Verify competition exists
+        c = await conn.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
+        if not await c.fetchone():
+            raise HTTPException(status_code=404, detail="Competition not found")
+        
+        c = await conn.execute("INSERT INTO assignments (competition_id, name, prompt) VALUES (?, ?, ?)",
+                               (competition_id, assignment.name, assignment.prompt))
+        assignment_id = c.lastrowid
     
     return {"id": assignment_id, "name": assignment.name, "prompt": assignment.prompt}
 
 @app.get("/competitions/{competition_id}/assignments")
 async def get_assignments(competition_id: int):
     """Get all assignments for competition"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM assignments WHERE competition_id = ?", (competition_id,))
-    assignments = [dict(row) for row in c.fetchall()]
-    conn.close()
+    async with get_read_conn() as conn:
+        c = await conn.execute("SELECT * FROM assignments WHERE competition_id = ?", (competition_id,))
+        assignments = [dict(row) for row in await c.fetchall()]
     return assignments
 
 # ==================== PARTICIPANT ENDPOINTS ====================
@@ -207,116 +196,118 @@ async def get_assignments(competition_id: int):
 @app.post("/competitions/{competition_id}/participants/upload")
 async def upload_participants(competition_id: int, file: UploadFile = File(...)):
     """Upload participants from CSV file"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Verify competition exists
-    c.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
-    if not c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Competition not found")
+    async with get_read_conn() as conn:
+        # Verify competition exists
+        c = await conn.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
+        if not await c.fetchone():
+            raise HTTPException(status_code=404, detail="Competition not found")
     
     # Read CSV
     content = await file.read()
     csv_file = io.StringIO(content.decode('utf-8'))
     reader = csv.DictReader(csv_file)
     
-    participants_added = 0
+    rows = []
     for row in reader:
         name = row.get('name') or row.get('이름')
         email = row.get('email') or row.get('이메일')
         student_id = row.get('student_id') or row.get('학번')
         
         if name:
-            c.execute("""INSERT INTO participants (competition_id, name, email, student_id)
-                        VALUES (?, ?, ?, ?)""",
-                     (competition_id, name, email, student_id))
-            participants_added += 1
+            rows.append((competition_id, name, email, student_id))
     
-    conn.commit()
-    conn.close()
+    async with get_write_conn() as conn:
+        await conn.executemany("""INSERT INTO participants (competition_id, name, email, student_id)
+                                 VALUES (?, ?, ?, ?)""", rows)
+    participants_added = len(rows)
     
     return {"message": f"{participants_added} participants added successfully"}
 
 @app.get("/competitions/{competition_id}/participants")
 async def get_participants(competition_id: int):
     """Get all participants for competition"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM participants WHERE competition_id = ?", (competition_id,))
-    participants = [dict(row) for row in c.fetchall()]
-    conn.close()
+    async with get_read_conn() as conn:
+        c = await conn.execute("SELECT * FROM participants WHERE competition_id = ?", (competition_id,))
+        participants = [dict(row) for row in await c.fetchall()]
     return participants
 
 # ==================== SUBMISSION ENDPOINTS ====================
 
+# participantname_assignmentname.txt (the assignment name may itself contain underscores)
+SUBMISSION_FILENAME = re.compile(r'^([^_]+)_(.+)\.txt$')
+
+def _read_submission_zip(zip_source, competition_id: int, participants: dict, assignments: dict):
+    """Collect submission rows and skipped-entry notes from a ZIP upload (blocking; run in a thread)"""
+    rows = []
+    skipped = []
+    
+    with zipfile.ZipFile(zip_source) as zip_file:
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            
+            # Decode filename (handle Korean filenames). Without the UTF-8 flag (bit 11)
+            # zipfile decodes names as CP437, so recover the raw bytes and re-decode them.
+            decoded_name = info.filename
+            if not info.flag_bits & 0x800:
+                raw_name = decoded_name.encode('cp437')
+                try:
+                    # Some archivers write UTF-8 names without setting the flag
+                    decoded_name = raw_name.decode('utf-8')
+                except UnicodeDecodeError:
+                    # CP949 (Korean Windows encoding)
+                    decoded_name = raw_name.decode('cp949', errors='replace')
+            
+            # Parse filename: participantname_assignmentname.txt (entries may sit inside a folder)
+            base_name = posixpath.basename(decoded_name.replace('\\', '/'))
+            m = SUBMISSION_FILENAME.match(base_name)
+            if not m:
+                if base_name.endswith('.txt'):
+                    skipped.append(f"{decoded_name} (expected participantname_assignmentname.txt)")
+                continue
+            participant_name, assignment_name = m.group(1), m.group(2)
+            
+            # Find participant and assignment
+            participant = participants.get(participant_name)
+            assignment = assignments.get(assignment_name)
+            
+            if participant and assignment:
+                # Read prompt text
+                with zip_file.open(info) as entry:
+                    prompt_text = entry.read().decode('utf-8')
+                rows.append((competition_id, participant['id'], assignment['id'], prompt_text))
+            else:
+                skipped.append(f"{participant_name}_{assignment_name} (participant: {participant_name in participants}, assignment: {assignment_name in assignments})")
+    
+    return rows, skipped
+
 @app.post("/competitions/{competition_id}/submissions/upload")
 async def upload_submissions(competition_id: int, file: UploadFile = File(...)):
     """Upload submissions from ZIP file"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Verify competition exists
-    c.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
-    if not c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Competition not found")
-    
-    # Get assignments
-    c.execute("SELECT * FROM assignments WHERE competition_id = ?", (competition_id,))
-    assignments = {row['name']: dict(row) for row in c.fetchall()}
-    
-    # Get participants
-    c.execute("SELECT * FROM participants WHERE competition_id = ?", (competition_id,))
-    participants = {row['name']: dict(row) for row in c.fetchall()}
-    
-    # Read ZIP file
-    content = await file.read()
-    zip_file = zipfile.ZipFile(io.BytesIO(content))
+    async with get_read_conn() as conn:
+        # Verify competition exists
+        c = await conn.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
+        if not await c.fetchone():
+            raise HTTPException(status_code=404, detail="Competition not found")
+        
+        # Get assignments
+        c = await conn.execute("SELECT * FROM assignments WHERE competition_id = ?", (competition_id,))
+        assignments = {row['name']: dict(row) for row in await c.fetchall()}
+        
+        # Get participants
+        c = await conn.execute("SELECT * FROM participants WHERE competition_id = ?", (competition_id,))
+        participants = {row['name']: dict(row) for row in await c.fetchall()}
     
-    submissions_added = 0
-    skipped = []
+    # UploadFile is already spooled (to disk once large), so read entries from it directly,
+    # off the event loop since listing and decompressing entries is blocking work
+    rows, skipped = await asyncio.to_thread(_read_submission_zip, file.file, competition_id, participants, assignments)
     
-    for file_name in zip_file.namelist():
-        # Try to decode filename (handle Korean filenames)
-        try:
-            # Try UTF-8 first
-            decoded_name = file_name
-        except:
-            try:
-                # Try CP949 (Korean Windows encoding)
-                decoded_name = file_name.encode('cp437').decode('utf-8')
-            except:
-                decoded_name = file_name
-        
-        if decoded_name.endswith('.txt'):
-            # Parse filename: participantname_assignmentname.txt
-            base_name = os.path.splitext(decoded_name)[0]
-            parts = base_name.split('_')
-            
-            if len(parts) >= 2:
-                participant_name = parts[0]
-                assignment_name = '_'.join(parts[1:])
-                
-                # Find participant and assignment
-                participant = participants.get(participant_name)
-                assignment = assignments.get(assignment_name)
-                
-                if participant and assignment:
-                    # Read prompt text
-                    prompt_text = zip_file.read(file_name).decode('utf-8')
-                    
-                    # Insert submission
-                    c.execute("""INSERT INTO submissions 
-                                (competition_id, participant_id, assignment_id, prompt_text, status)
-                                VALUES (?, ?, ?, ?, 'pending')""",
-                             (competition_id, participant['id'], assignment['id'], prompt_text))
-                    submissions_added += 1
-                else:
-                    skipped.append(f"{participant_name}_{assignment_name} (participant: {participant_name in participants}, assignment: {assignment_name in assignments})")
-    
-    conn.commit()
-    conn.close()
+    # Insert submissions
+    async with get_write_conn() as conn:
+        await conn.executemany("""INSERT INTO submissions 
+                                 (competition_id, participant_id, assignment_id, prompt_text, status)
+                                 VALUES (?, ?, ?, ?, 'pending')""", rows)
+    submissions_added = len(rows)
     
     result = {"message": f"{submissions_added} submissions uploaded successfully"}
     if skipped:
@@ -326,102 +317,148 @@ async def upload_submissions(competition_id: int, file: UploadFile = File(...)):
 @app.get("/competitions/{competition_id}/submissions")
 async def get_submissions(competition_id: int):
     """Get all submissions for competition"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT s.*, p.name as participant_name, a.name as assignment_name
-        FROM submissions s
-        JOIN participants p ON s.participant_id = p.id
-        JOIN assignments a ON s.assignment_id = a.id
-        WHERE s.competition_id = ?
-        ORDER BY s.submitted_at DESC
-    """, (competition_id,))
-    submissions = [dict(row) for row in c.fetchall()]
-    conn.close()
+    async with get_read_conn() as conn:
+        c = await conn.execute("""
+            SELECT s.*, p.name as participant_name, a.name as assignment_name
+            FROM submissions s
+            JOIN participants p ON s.participant_id = p.id
+            JOIN assignments a ON s.assignment_id = a.id
+            WHERE s.competition_id = ?
+            ORDER BY s.submitted_at DESC
+        """, (competition_id,))
+        submissions = [dict(row) for row in await c.fetchall()]
     return submissions
 
 # ==================== GRADING ENDPOINTS ====================
 
+# Number of finished submissions to accumulate before writing them in one transaction
+WRITE_BATCH_SIZE = 20
+
 async def grade_all_submissions_background(competition_id: int):
     """Background task to grade all pending submissions"""
     print(f"[GRADING] Background task started for competition {competition_id}")
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get all pending submissions
-    c.execute("""
-        SELECT s.*, a.prompt as assignment_prompt
-        FROM submissions s
-        JOIN assignments a ON s.assignment_id = a.id
-        WHERE s.competition_id = ? AND s.status = 'pending'
-    """, (competition_id,))
+    async with get_write_conn() as conn:
+        # Get all pending submissions
+        c = await conn.execute("""
+            SELECT s.*, a.prompt as assignment_prompt
+            FROM submissions s
+            JOIN assignments a ON s.assignment_id = a.id
+            WHERE s.competition_id = ? AND s.status = 'pending'
+        """, (competition_id,))
+        
+        submissions = await c.fetchall()
+        
+        # Claim them all at once so a concurrent grading run does not pick them up again
+        await conn.executemany("UPDATE submissions SET status = 'grading' WHERE id = ?",
+                               [(s['id'],) for s in submissions])
     
-    submissions = c.fetchall()
     total = len(submissions)
     
     print(f"[GRADING] Found {total} pending submissions")
     
-    for idx, submission in enumerate(submissions, 1):
-        submission_id = submission['id']
+    # Group submissions sharing an assignment so each request grades several at once
+    batch_size = int(os.getenv("GRADER_BATCH_SIZE", "8"))
+    by_assignment = {}
+    for submission in submissions:
+        by_assignment.setdefault(submission['assignment_id'], []).append(submission)
+    
+    batches = []
+    for group in by_assignment.values():
+        for i in range(0, len(group), batch_size):
+            batches.append(group[i:i + batch_size])
+    
+    print(f"[GRADING] Grading in {len(batches)} batches (batch size {batch_size})")
+    
+    # Bound in-flight batches to respect OpenAI rate limits
+    sem = asyncio.Semaphore(int(os.getenv("GRADER_CONCURRENCY", "10")))
+    done = 0
+    
+    # Finished rows are written in groups to keep the number of commits low
+    pending_writes = []
+    written = set()
+    
+    async def _flush():
+        nonlocal pending_writes
+        rows, pending_writes = pending_writes, []
+        if rows:
+            async with get_write_conn() as conn:
+                await conn.executemany("""
+                    UPDATE submissions 
+                    SET status = ?, 
+                        score = ?, 
+                        feedback = ?,
+                        grading_details = ?
+                    WHERE id = ?
+                """, rows)
+            written.update(row[-1] for row in rows)
+    
+    async def _grade_batch(batch):
+        nonlocal done
+        submission_ids = [s['id'] for s in batch]
         
-        print(f"[GRADING] Processing {idx}/{total}: submission_id={submission_id}")
-        
-        # Update status to grading
-        c.execute("UPDATE submissions SET status = 'grading' WHERE id = ?", (submission_id,))
-        conn.commit()
-        
-        try:
-            # Grade submission
-            result = grade_submission(
-                task_prompt=submission['assignment_prompt'],
-                user_prompt=submission['prompt_text']
-            )
-            
-            # Update with results
-            c.execute("""
-                UPDATE submissions 
-                SET status = 'completed', 
-                    score = ?, 
-                    feedback = ?,
-                    grading_details = ?
-                WHERE id = ?
-            """, (result['average_score'], result['feedback'], 
-                  json.dumps(result['detailed_scores']), submission_id))
+        async with sem:
+            print(f"[GRADING] Processing batch: submission_ids={submission_ids}")
             
-            print(f"[GRADING] ✓ Completed {idx}/{total}: score={result['average_score']}")
+            try:
+                # Grade submissions
+                results = await grade_submissions_batched(
+                    task_prompt=batch[0]['assignment_prompt'],
+                    user_prompts=[s['prompt_text'] for s in batch]
+                )
+                
+                for submission_id, result in zip(submission_ids, results):
+                    if isinstance(result, Exception):
+                        print(f"[GRADING_ERROR] ✗ Submission {submission_id} failed: {str(result)}")
+                        pending_writes.append(('error', None, f"Grading failed: {str(result)}", None, submission_id))
+                    else:
+                        pending_writes.append(('completed', result['average_score'], result['feedback'],
+                                               orjson.dumps(result['detailed_scores']).decode(), submission_id))
+                
+                done += len(batch)
+                print(f"[GRADING] ✓ Completed {done}/{total}: scores={[r['average_score'] if isinstance(r, dict) else None for r in results]}")
+                
+            except Exception as e:
+                done += len(batch)
+                print(f"[GRADING_ERROR] ✗ Failed {done}/{total}: {str(e)}")
+                pending_writes.extend(
+                    ('error', None, f"Grading failed: {str(e)}", None, submission_id)
+                    for submission_id in submission_ids
+                )
             
-        except Exception as e:
-            print(f"[GRADING_ERROR] ✗ Failed {idx}/{total}: {str(e)}")
-            c.execute("""
-                UPDATE submissions 
-                SET status = 'error', 
-                    feedback = ?
-                WHERE id = ?
-            """, (f"Grading failed: {str(e)}", submission_id))
-        
-        conn.commit()
+            if len(pending_writes) >= WRITE_BATCH_SIZE:
+                await _flush()
+    
+    try:
+        # Let every batch finish even if one of their flushes fails
+        for failure in await asyncio.gather(*[_grade_batch(batch) for batch in batches], return_exceptions=True):
+            if isinstance(failure, Exception):
+                print(f"[GRADING_ERROR] Failed to save results: {str(failure)}")
+        await _flush()
+    finally:
+        # Claimed rows whose results never reached the database go back to the queue
+        unwritten = [(s['id'],) for s in submissions if s['id'] not in written]
+        if unwritten:
+            print(f"[GRADING] Returning {len(unwritten)} unsaved submissions to pending")
+            async with get_write_conn() as conn:
+                await conn.executemany("UPDATE submissions SET status = 'pending' WHERE id = ? AND status = 'grading'",
+                                       unwritten)
     
-    conn.close()
     print(f"[GRADING] Background task completed for competition {competition_id}")
 
 @app.post("/competitions/{competition_id}/grade")
 async def start_grading(competition_id: int, background_tasks: BackgroundTasks):
     """Start grading all pending submissions"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Verify competition exists
-    c.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
-    if not c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Competition not found")
-    
-    # Count pending submissions
-    c.execute("SELECT COUNT(*) as count FROM submissions WHERE competition_id = ? AND status = 'pending'",
-              (competition_id,))
-    count = c.fetchone()['count']
-    conn.close()
+    async with get_read_conn() as conn:
+        # Verify competition exists
+        c = await conn.execute("SELECT id FROM competitions WHERE id = ?", (competition_id,))
+        if not await c.fetchone():
+            raise HTTPException(status_code=404, detail="Competition not found")
+        
+        # Count pending submissions
+        c = await conn.execute("SELECT COUNT(*) as count FROM submissions WHERE competition_id = ? AND status = 'pending'",
+                               (competition_id,))
+        count = (await c.fetchone())['count']
     
     if count == 0:
         return {"message": "No pending submissions to grade"}
@@ -434,18 +471,15 @@ async def start_grading(competition_id: int, background_tasks: BackgroundTasks):
 @app.get("/competitions/{competition_id}/grading-status")
 async def get_grading_status(competition_id: int):
     """Get grading progress"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    c.execute("""
-        SELECT status, COUNT(*) as count
-        FROM submissions
-        WHERE competition_id = ?
-        GROUP BY status
-    """, (competition_id,))
-    
-    status_counts = {row['status']: row['count'] for row in c.fetchall()}
-    conn.close()
+    async with get_read_conn() as conn:
+        c = await conn.execute("""
+            SELECT status, COUNT(*) as count
+            FROM submissions
+            WHERE competition_id = ?
+            GROUP BY status
+        """, (competition_id,))
+        
+        status_counts = {row['status']: row['count'] for row in await c.fetchall()}
     
     total = sum(status_counts.values())
     
@@ -462,35 +496,28 @@ async def get_grading_status(competition_id: int):
 @app.get("/competitions/{competition_id}/leaderboard")
 async def get_leaderboard(competition_id: int):
     """Get competition leaderboard"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    c.execute("""
-        SELECT 
-            p.id,
-            p.name,
-            p.email,
-            p.student_id,
-            AVG(s.score) as average_score,
-            COUNT(s.id) as submission_count,
-            SUM(CASE WHEN s.status = 'completed' THEN 1 ELSE 0 END) as graded_count
-        FROM participants p
-        LEFT JOIN submissions s ON p.id = s.participant_id AND s.competition_id = ?
-        WHERE p.competition_id = ?
-        GROUP BY p.id, p.name, p.email, p.student_id
-        ORDER BY average_score DESC NULLS LAST
-    """, (competition_id, competition_id))
-    
-    leaderboard = []
-    rank = 1
-    for row in c.fetchall():
-        entry = dict(row)
-        entry['rank'] = rank if entry['average_score'] is not None else None
-        leaderboard.append(entry)
-        if entry['average_score'] is not None:
-            rank += 1
-    
-    conn.close()
+    async with get_read_conn() as conn:
+        c = await conn.execute("""
+            SELECT 
+                p.id,
+                p.name,
+                p.email,
+                p.student_id,
+                AVG(s.score) as average_score,
+                COUNT(s.id) as submission_count,
+                SUM(CASE WHEN s.status = 'completed' THEN 1 ELSE 0 END) as graded_count,
+                CASE WHEN AVG(s.score) IS NOT NULL
+                     THEN RANK() OVER (ORDER BY AVG(s.score) DESC NULLS LAST)
+                END as rank
+            FROM participants p
+            LEFT JOIN submissions s ON p.id = s.participant_id AND s.competition_id = ?
+            WHERE p.competition_id = ?
+            GROUP BY p.id, p.name, p.email, p.student_id
+            ORDER BY average_score DESC NULLS LAST
+        """, (competition_id, competition_id))
+        
+        leaderboard = [dict(row) for row in await c.fetchall()]
+    
     return leaderboard
 
 # ==================== ANALYSIS REPORT ENDPOINTS ====================
@@ -498,64 +525,96 @@ async def get_leaderboard(competition_id: int):
 @app.get("/competitions/{competition_id}/report")
 async def generate_report(competition_id: int):
     """Generate analysis report for competition"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get competition info
-    c.execute("SELECT * FROM competitions WHERE id = ?", (competition_id,))
-    competition = c.fetchone()
-    if not competition:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Competition not found")
-    
-    # Get all completed submissions with details
-    c.execute("""
-        SELECT 
-            s.*,
-            p.name as participant_name,
-            a.name as assignment_name
-        FROM submissions s
-        JOIN participants p ON s.participant_id = p.id
-        JOIN assignments a ON s.assignment_id = a.id
-        WHERE s.competition_id = ? AND s.status = 'completed'
-    """, (competition_id,))
-    
-    submissions = [dict(row) for row in c.fetchall()]
-    
-    if not submissions:
-        conn.close()
-        return {
-            "message": "No completed submissions yet",
-            "statistics": None
-        }
-    
-    # Calculate overall statistics
-    scores = [s['score'] for s in submissions if s['score'] is not None]
+    async with get_read_conn() as conn:
+        # Get competition info
+        c = await conn.execute("SELECT * FROM competitions WHERE id = ?", (competition_id,))
+        competition = await c.fetchone()
+        if not competition:
+            raise HTTPException(status_code=404, detail="Competition not found")
+        
+        # Overall statistics and score distribution in a single scan
+        c = await conn.execute("""
+            SELECT 
+                COUNT(*) as total_submissions,
+                COUNT(score) as scored,
+                AVG(score) as mean_score,
+                MIN(score) as min_score,
+                MAX(score) as max_score,
+                SUM(score * score) as sum_sq,
+                COUNT(CASE WHEN score <= 20 THEN 1 END) as bin_0_20,
+                COUNT(CASE WHEN score > 20 AND score <= 40 THEN 1 END) as bin_21_40,
+                COUNT(CASE WHEN score > 40 AND score <= 60 THEN 1 END) as bin_41_60,
+                COUNT(CASE WHEN score > 60 AND score <= 80 THEN 1 END) as bin_61_80,
+                COUNT(CASE WHEN score > 80 THEN 1 END) as bin_81_100
+            FROM submissions
+            WHERE competition_id = ? AND status = 'completed'
+        """, (competition_id,))
+        
+        totals = await c.fetchone()
+        
+        if not totals['total_submissions']:
+            return {
+                "message": "No completed submissions yet",
+                "statistics": None
+            }
+        
+        # Median from the one or two middle scores
+        n = totals['scored']
+        c = await conn.execute("""
+            SELECT score FROM submissions
+            WHERE competition_id = ? AND status = 'completed' AND score IS NOT NULL
+            ORDER BY score
+            LIMIT ? OFFSET ?
+        """, (competition_id, 2 - n % 2, (n - 1) // 2))
+        
+        middle = [row['score'] for row in await c.fetchall()]
+        
+        # Assignment-wise analysis
+        c = await conn.execute("""
+            SELECT 
+                a.name as assignment_name,
+                COUNT(s.id) as submission_count,
+                AVG(s.score) as avg_score,
+                MIN(s.score) as min_score,
+                MAX(s.score) as max_score
+            FROM assignments a
+            LEFT JOIN submissions s ON a.id = s.assignment_id AND s.status = 'completed'
+            WHERE a.competition_id = ?
+            GROUP BY a.id, a.name
+        """, (competition_id,))
+        
+        assignment_stats = [dict(row) for row in await c.fetchall()]
+        
+        # Top performers
+        c = await conn.execute("""
+            SELECT 
+                p.name,
+                AVG(s.score) as avg_score,
+                COUNT(s.id) as submission_count
+            FROM participants p
+            JOIN submissions s ON p.id = s.participant_id AND s.status = 'completed'
+            WHERE s.competition_id = ?
+            GROUP BY p.id, p.name
+            ORDER BY avg_score DESC
+            LIMIT 10
+        """, (competition_id,))
+        
+        top_performers = [dict(row) for row in await c.fetchall()]
+    
+    # Sample standard deviation from the running sums
+    n = totals['scored']
+    mean = totals['mean_score']
+    std_dev = math.sqrt(max(totals['sum_sq'] - n * mean * mean, 0) / (n - 1)) if n > 1 else 0
     
     overall_stats = {
-        "total_submissions": len(submissions),
-        "mean_score": round(statistics.mean(scores), 2) if scores else 0,
-        "median_score": round(statistics.median(scores), 2) if scores else 0,
-        "std_dev": round(statistics.stdev(scores), 2) if len(scores) > 1 else 0,
-        "min_score": round(min(scores), 2) if scores else 0,
-        "max_score": round(max(scores), 2) if scores else 0
+        "total_submissions": totals['total_submissions'],
+        "mean_score": round(mean, 2) if n else 0,
+        "median_score": round(sum(middle) / len(middle), 2) if n else 0,
+        "std_dev": round(std_dev, 2),
+        "min_score": round(totals['min_score'], 2) if n else 0,
+        "max_score": round(totals['max_score'], 2) if n else 0
     }
     
-    # Assignment-wise analysis
-    c.execute("""
-        SELECT 
-            a.name as assignment_name,
-            COUNT(s.id) as submission_count,
-            AVG(s.score) as avg_score,
-            MIN(s.score) as min_score,
-            MAX(s.score) as max_score
-        FROM assignments a
-        LEFT JOIN submissions s ON a.id = s.assignment_id AND s.status = 'completed'
-        WHERE a.competition_id = ?
-        GROUP BY a.id, a.name
-    """, (competition_id,))
-    
-    assignment_stats = [dict(row) for row in c.fetchall()]
     for stat in assignment_stats:
         if stat['avg_score']:
             stat['avg_score'] = round(stat['avg_score'], 2)
@@ -564,47 +623,18 @@ async def generate_report(competition_id: int):
         if stat['max_score']:
             stat['max_score'] = round(stat['max_score'], 2)
     
-    # Top performers
-    c.execute("""
-        SELECT 
-            p.name,
-            AVG(s.score) as avg_score,
-            COUNT(s.id) as submission_count
-        FROM participants p
-        JOIN submissions s ON p.id = s.participant_id AND s.status = 'completed'
-        WHERE s.competition_id = ?
-        GROUP BY p.id, p.name
-        ORDER BY avg_score DESC
-        LIMIT 10
-    """, (competition_id,))
-    
-    top_performers = [dict(row) for row in c.fetchall()]
     for performer in top_performers:
         performer['avg_score'] = round(performer['avg_score'], 2)
     
     # Score distribution (bins)
     score_bins = {
-        "0-20": 0,
-        "21-40": 0,
-        "41-60": 0,
-        "61-80": 0,
-        "81-100": 0
+        "0-20": totals['bin_0_20'],
+        "21-40": totals['bin_21_40'],
+        "41-60": totals['bin_41_60'],
+        "61-80": totals['bin_61_80'],
+        "81-100": totals['bin_81_100']
     }
     
-    for score in scores:
-        if score <= 20:
-            score_bins["0-20"] += 1
-        elif score <= 40:
-            score_bins["21-40"] += 1
-        elif score <= 60:
-            score_bins["41-60"] += 1
-        elif score <= 80:
-            score_bins["61-80"] += 1
-        else:
-            score_bins["81-100"] += 1
-    
-    conn.close()
-    
     return {
         "competition": dict(competition),
         "overall_statistics": overall_stats,